@@ -3,17 +3,32 @@
 # POST /ingest - Upload consciousness files
 # GET /vault/<id> - Retrieve consciousness files
 
+# Patch sockets before anything else imports them so botocore I/O yields
+# to other requests under gunicorn's gevent workers
+from gevent import monkey
+monkey.patch_all()
+
 from flask import Flask, request, jsonify, send_file
 from werkzeug.utils import secure_filename
+import atexit
 import hashlib
-import json
+import mmap
+import orjson
 import os
+import re
+import sqlite3
 import uuid
-import io
+import tempfile
 from datetime import datetime
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import logging
+from vault_common import (
+    JsonlLogWriter, HashingWriter, get_index_connection, ensure_index_schema,
+    legacy_object_key
+)
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max file size
@@ -29,22 +44,135 @@ SPACES_BUCKET = 'aicara-vault'
 SPACES_REGION = 'nyc3'  # or your preferred region
 SPACES_ENDPOINT = f'https://{SPACES_REGION}.digitaloceanspaces.com'
 
+# Keep-alive connection pool so requests reuse TLS sessions, sized for one
+# gevent worker's concurrent connections; adaptive retries absorb transient
+# Spaces failures
+SPACES_CLIENT_CONFIG = Config(
+    max_pool_connections=100,
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=30,
+    retries={'mode': 'adaptive', 'max_attempts': 5}
+)
+
 # Initialize DigitalOcean Spaces client
 spaces_client = boto3.client(
     's3',
     endpoint_url=SPACES_ENDPOINT,
     aws_access_key_id=SPACES_KEY,
     aws_secret_access_key=SPACES_SECRET,
-    region_name=SPACES_REGION
+    region_name=SPACES_REGION,
+    config=SPACES_CLIENT_CONFIG
 )
 
 VAULT_LOG_FILE = 'vault_log.jsonl'
+# Canonical lowercase UUID, as generated by ingest
+VAULT_ID_RE = re.compile(r'\A[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z')
+# 1MB chunks for streamed hashing: used as the s3transfer io_chunksize and by
+# the ingest drain loop, so each hashlib update covers a full 1MB read.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Multipart upload settings for streaming ingest
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    use_threads=True
+)
+
+# Concurrent 8MB range GETs for large downloads (small objects use one GET)
+DOWNLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    io_chunksize=HASH_CHUNK_SIZE
+)
+
+def calculate_sha256_buffer(payload):
+    """Calculate SHA-256 hash of a payload already in memory in a single call"""
+    return hashlib.sha256(payload).hexdigest()
+
+def calculate_sha256_file(fileobj):
+    """Calculate SHA-256 hash of an on-disk file by mapping it into memory"""
+    fileobj.flush()
+    if os.fstat(fileobj.fileno()).st_size == 0:
+        return calculate_sha256_buffer(b'')  # Empty files cannot be mapped
+    with mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return calculate_sha256_buffer(mapped)
 
-def calculate_sha256(file_content):
-    """Calculate SHA-256 hash of file content"""
-    return hashlib.sha256(file_content).hexdigest()
+# Background JSONL writer shared with bastion_cron.py, see vault_common.py
+_log_writer = JsonlLogWriter(VAULT_LOG_FILE, 'vault log', 'vault-log-writer')
+write_log_entry = _log_writer.write
+shutdown_log_writer = _log_writer.shutdown
 
-def log_vault_operation(operation, filename, file_hash, vault_id=None, status='success', error=None):
+atexit.register(shutdown_log_writer)
+
+class HashingReader:
+    """Read-only stream wrapper that hashes and counts bytes as they are read
+    
+    Deliberately exposes no seek/tell so boto3 treats it as non-seekable and
+    reads it strictly in order, which keeps the running hash correct.
+    """
+    
+    def __init__(self, stream, sha256):
+        self.stream = stream
+        self.sha256 = sha256
+        self.bytes_read = 0
+    
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.sha256.update(chunk)
+        self.bytes_read += len(chunk)
+        return chunk
+
+# PRAGMA user_version once the one-time backfill from vault_log.jsonl has committed
+INDEX_BACKFILLED_VERSION = 1
+
+def init_vault_index():
+    """Create the vault index, backfilling it from vault_log.jsonl when new
+    
+    Everything runs in one explicit transaction: sqlite3 would otherwise run
+    CREATE TABLE outside it, so a failed backfill would leave an empty table
+    that looks initialized. Completion is recorded in PRAGMA user_version.
+    """
+    conn = get_index_connection()
+    try:
+        with conn:
+            # Take the write lock up front so gunicorn workers initialize one at a time
+            conn.execute('BEGIN IMMEDIATE')
+            ensure_index_schema(conn)
+            
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= INDEX_BACKFILLED_VERSION:
+                return
+            
+            # One-time import of ingests logged before the index existed; rows
+            # already indexed are kept as they are
+            if os.path.exists(VAULT_LOG_FILE):
+                with open(VAULT_LOG_FILE, 'rb') as f:
+                    for line_number, line in enumerate(f, 1):
+                        if not line.strip():
+                            continue
+                        try:
+                            entry = orjson.loads(line)
+                        except orjson.JSONDecodeError as e:
+                            # e.g. a torn final line from a process killed mid-append
+                            logger.warning(f"Skipping unreadable vault log line {line_number}: {e}")
+                            continue
+                        if not isinstance(entry, dict):
+                            logger.warning(f"Skipping non-object vault log line {line_number}")
+                            continue
+                        if entry.get('operation') == 'ingest' and entry.get('status') == 'success':
+                            conn.execute(
+                                'INSERT OR IGNORE INTO ingest (vault_id, filename, sha256, ts, object_key) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (entry.get('vault_id'), entry.get('filename'), entry.get('sha256_hash'),
+                                 entry.get('timestamp'), entry.get('object_key'))
+                            )
+            
+            conn.execute(f'PRAGMA user_version = {INDEX_BACKFILLED_VERSION}')
+    finally:
+        conn.close()
+
+def log_vault_operation(operation, filename, file_hash, vault_id=None, status='success', error=None,
+                        object_key=None):
     """Log vault operations to vault_log.jsonl"""
     log_entry = {
         'timestamp': datetime.utcnow().isoformat(),
@@ -52,43 +180,135 @@ def log_vault_operation(operation, filename, file_hash, vault_id=None, status='s
         'filename': filename,
         'sha256_hash': file_hash,
         'vault_id': vault_id,
+        'object_key': object_key,
         'status': status,
         'error': error
     }
     
     try:
-        with open(VAULT_LOG_FILE, 'a') as f:
-            f.write(json.dumps(log_entry) + '\n')
+        write_log_entry(log_entry)
     except Exception as e:
         logger.error(f"Failed to write to vault log: {e}")
 
-def upload_to_spaces(file_content, filename, vault_id):
-    """Upload file to DigitalOcean Spaces"""
+def record_ingest(vault_id, filename, file_hash, object_key):
+    """Record a stored file in the vault index, raising sqlite3.Error on failure
+    
+    The index is the only synchronous record of a file's content-addressed
+    key, so an ingest is not successful until this has committed.
+    """
+    conn = get_index_connection()
     try:
-        spaces_client.put_object(
-            Bucket=SPACES_BUCKET,
-            Key=f'consciousness/{vault_id}/{filename}',
-            Body=file_content,
-            ContentType='application/octet-stream',
-            ACL='private'  # Ensure private access
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO ingest (vault_id, filename, sha256, ts, object_key) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (vault_id, filename, file_hash, datetime.utcnow().isoformat(), object_key)
+            )
+    finally:
+        conn.close()
+
+def lookup_ingest(vault_id, filename=None):
+    """Look up an ingest record in the vault index, or None if not found"""
+    conn = get_index_connection()
+    try:
+        if filename is None:
+            return conn.execute(
+                'SELECT filename, sha256, ts, object_key FROM ingest WHERE vault_id = ? LIMIT 1',
+                (vault_id,)
+            ).fetchone()
+        return conn.execute(
+            'SELECT filename, sha256, ts, object_key FROM ingest WHERE vault_id = ? AND filename = ?',
+            (vault_id, filename)
+        ).fetchone()
+    finally:
+        conn.close()
+
+def content_object_key(file_hash):
+    """Content-addressed Spaces key for a file with the given SHA-256"""
+    return f'ca/{file_hash[:2]}/{file_hash[2:]}'
+
+def resolve_vault_file(vault_id, filename=None):
+    """Resolve a vault file to (filename, original_hash, object_key), or None if unknown
+    
+    Files missing from the index are assumed to live under the legacy key.
+    """
+    record = lookup_ingest(vault_id, filename)
+    if record is not None:
+        indexed_filename, indexed_hash, _, object_key = record
+        return indexed_filename, indexed_hash, object_key or legacy_object_key(vault_id, indexed_filename)
+    if filename:
+        return filename, None, legacy_object_key(vault_id, filename)
+    return None
+
+def upload_to_spaces(fileobj, key):
+    """Upload file object to DigitalOcean Spaces"""
+    try:
+        spaces_client.upload_fileobj(
+            fileobj,
+            SPACES_BUCKET,
+            key,
+            ExtraArgs={
+                'ContentType': 'application/octet-stream',
+                'ACL': 'private'  # Ensure private access
+            },
+            Config=UPLOAD_TRANSFER_CONFIG
         )
         return True
     except ClientError as e:
         logger.error(f"Failed to upload to Spaces: {e}")
         return False
 
-def download_from_spaces(vault_id, filename):
-    """Download file from DigitalOcean Spaces"""
+def store_content_addressed(staging_key, file_hash):
+    """Move a staged upload to its content-addressed key
+    
+    The hash is only known once the streamed upload finishes, so the staged
+    object is copied server-side (with x-amz-meta-sha256 attached). Identical
+    files share the key; the copy always runs so a re-ingest replaces a stored
+    object that has rotted. Returns the final key, or None on failure.
+    """
+    key = content_object_key(file_hash)
     try:
-        response = spaces_client.get_object(
+        spaces_client.copy_object(
             Bucket=SPACES_BUCKET,
-            Key=f'consciousness/{vault_id}/{filename}'
+            Key=key,
+            CopySource={'Bucket': SPACES_BUCKET, 'Key': staging_key},
+            Metadata={'sha256': file_hash},
+            MetadataDirective='REPLACE',
+            ContentType='application/octet-stream',
+            ACL='private'  # Ensure private access
         )
-        return response['Body'].read()
+    except ClientError as e:
+        logger.error(f"Failed to store content-addressed copy in Spaces: {e}")
+        return None
+    finally:
+        try:
+            spaces_client.delete_object(Bucket=SPACES_BUCKET, Key=staging_key)
+        except ClientError as e:
+            logger.error(f"Failed to remove staged upload {staging_key}: {e}")
+    return key
+
+def open_from_spaces(key):
+    """Open a streaming download from DigitalOcean Spaces (get_object response)"""
+    try:
+        return spaces_client.get_object(Bucket=SPACES_BUCKET, Key=key)
     except ClientError as e:
         logger.error(f"Failed to download from Spaces: {e}")
         return None
 
+def download_from_spaces(key, fileobj):
+    """Download file from DigitalOcean Spaces into a writable file object"""
+    try:
+        spaces_client.download_fileobj(
+            SPACES_BUCKET,
+            key,
+            fileobj,
+            Config=DOWNLOAD_TRANSFER_CONFIG
+        )
+        return True
+    except ClientError as e:
+        logger.error(f"Failed to download from Spaces: {e}")
+        return False
+
 @app.route('/', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -120,25 +340,44 @@ def ingest_consciousness():
         if not original_filename:
             return jsonify({'error': 'Invalid filename'}), 400
         
-        # Read file content
-        file_content = file.read()
-        file_size = len(file_content)
-        
-        # Calculate SHA-256 hash
-        file_hash = calculate_sha256(file_content)
-        
         # Generate unique vault ID
         vault_id = str(uuid.uuid4())
         
-        # Upload to DigitalOcean Spaces
-        upload_success = upload_to_spaces(file_content, original_filename, vault_id)
+        # Upload to a staging key in DigitalOcean Spaces, hashing in the same pass
+        staging_key = f'incoming/{vault_id}'
+        reader = HashingReader(file.stream, hashlib.sha256())
+        upload_success = upload_to_spaces(reader, staging_key)
+        
+        if not upload_success:
+            # Hash whatever the failed upload left unread so the log is accurate
+            while reader.read(HASH_CHUNK_SIZE):
+                pass
+        
+        file_hash = reader.sha256.hexdigest()
+        file_size = reader.bytes_read
         
         if not upload_success:
             log_vault_operation('ingest', original_filename, file_hash, vault_id, 'failed', 'Upload to Spaces failed')
             return jsonify({'error': 'Failed to store file in vault'}), 500
         
+        # Store under the content-addressed key now that the hash is known
+        object_key = store_content_addressed(staging_key, file_hash)
+        
+        if object_key is None:
+            log_vault_operation('ingest', original_filename, file_hash, vault_id, 'failed', 'Upload to Spaces failed')
+            return jsonify({'error': 'Failed to store file in vault'}), 500
+        
+        # Index the file before reporting success; without a row it cannot be found again
+        try:
+            record_ingest(vault_id, original_filename, file_hash, object_key)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to update vault index: {e}")
+            log_vault_operation('ingest', original_filename, file_hash, vault_id, 'failed',
+                                'Vault index update failed', object_key=object_key)
+            return jsonify({'error': 'Failed to store file in vault'}), 500
+        
         # Log successful operation
-        log_vault_operation('ingest', original_filename, file_hash, vault_id, 'success')
+        log_vault_operation('ingest', original_filename, file_hash, vault_id, 'success', object_key=object_key)
         
         logger.info(f"Consciousness file ingested: {vault_id} - {original_filename} ({file_size} bytes)")
         
@@ -160,12 +399,11 @@ def retrieve_consciousness(vault_id):
     """
     GET /vault/<id> - Retrieve consciousness files from vault
     Returns the stored file or metadata based on query params
+    Pass verify=1 to hash the file on the way out and check it against the ingest hash
     """
     try:
         # Validate vault_id format (should be UUID)
-        try:
-            uuid.UUID(vault_id)
-        except ValueError:
+        if not VAULT_ID_RE.match(vault_id):
             return jsonify({'error': 'Invalid vault ID format'}), 400
         
         # Get filename from query params or default search
@@ -173,44 +411,85 @@ def retrieve_consciousness(vault_id):
         metadata_only = request.args.get('metadata_only', 'false').lower() == 'true'
         
         if metadata_only:
-            # Return metadata from vault log
-            try:
-                with open(VAULT_LOG_FILE, 'r') as f:
-                    for line in f:
-                        entry = json.loads(line.strip())
-                        if entry.get('vault_id') == vault_id and entry.get('operation') == 'ingest':
-                            return jsonify({
-                                'vault_id': vault_id,
-                                'filename': entry.get('filename'),
-                                'sha256_hash': entry.get('sha256_hash'),
-                                'timestamp': entry.get('timestamp'),
-                                'status': entry.get('status')
-                            })
+            # Return metadata from vault index
+            record = lookup_ingest(vault_id)
+            if record is None:
                 return jsonify({'error': 'Vault ID not found'}), 404
-            except FileNotFoundError:
-                return jsonify({'error': 'Vault log not found'}), 404
+            
+            indexed_filename, indexed_hash, indexed_ts, _ = record
+            return jsonify({
+                'vault_id': vault_id,
+                'filename': indexed_filename,
+                'sha256_hash': indexed_hash,
+                'timestamp': indexed_ts,
+                'status': 'success'
+            })
+        
+        # Resolve the stored object; filename is optional for indexed files
+        resolved = resolve_vault_file(vault_id, filename)
+        if resolved is None:
+            return jsonify({'error': 'Vault ID not found'}), 404
         
-        if not filename:
-            return jsonify({'error': 'Filename required for file retrieval'}), 400
+        filename, original_hash, object_key = resolved
         
-        # Download file from Spaces
-        file_content = download_from_spaces(vault_id, filename)
+        if request.args.get('verify') == '1':
+            # Download file from Spaces to a temp file (removed once it is closed)
+            file_buffer = tempfile.TemporaryFile()
+            
+            if not download_from_spaces(object_key, file_buffer):
+                file_buffer.close()
+                log_vault_operation('retrieve', filename, '', vault_id, 'failed', 'File not found in vault')
+                return jsonify({'error': 'File not found in vault'}), 404
+            
+            # Verify file integrity against the hash recorded at ingest
+            file_hash = calculate_sha256_file(file_buffer)
+            
+            if original_hash and file_hash != original_hash:
+                file_buffer.close()
+                log_vault_operation('retrieve', filename, file_hash, vault_id, 'corrupted', 'Hash mismatch')
+                return jsonify({
+                    'error': 'File failed integrity verification',
+                    'original_hash': original_hash,
+                    'current_hash': file_hash
+                }), 500
+            
+            # Unindexed legacy files have no original hash to compare against
+            log_vault_operation('retrieve', filename, file_hash, vault_id,
+                                'success' if original_hash else 'success_unverified')
+            
+            # Return file content
+            file_size = os.fstat(file_buffer.fileno()).st_size
+            file_buffer.seek(0)
+            file_response = send_file(
+                file_buffer,
+                as_attachment=True,
+                download_name=filename,
+                mimetype='application/octet-stream'
+            )
+            if file_response.status_code == 200:
+                file_response.content_length = file_size
+            return file_response
         
-        if file_content is None:
+        # Stream file straight from Spaces without hashing
+        response = open_from_spaces(object_key)
+        
+        if response is None:
             log_vault_operation('retrieve', filename, '', vault_id, 'failed', 'File not found in vault')
             return jsonify({'error': 'File not found in vault'}), 404
         
-        # Verify file integrity
-        file_hash = calculate_sha256(file_content)
-        log_vault_operation('retrieve', filename, file_hash, vault_id, 'success')
+        log_vault_operation('retrieve', filename, None, vault_id, 'success_unverified')
         
-        # Return file content
-        return send_file(
-            io.BytesIO(file_content),
+        file_response = send_file(
+            response['Body'],
             as_attachment=True,
             download_name=filename,
-            mimetype='application/octet-stream'
+            mimetype='application/octet-stream',
+            etag=response['ETag'].strip('"'),
+            conditional=True
         )
+        if file_response.status_code == 200:
+            file_response.content_length = response['ContentLength']
+        return file_response
         
     except Exception as e:
         logger.error(f"Error retrieving consciousness: {e}")
@@ -224,38 +503,27 @@ def verify_consciousness(vault_id):
     """
     try:
         # Validate vault_id format
-        try:
-            uuid.UUID(vault_id)
-        except ValueError:
+        if not VAULT_ID_RE.match(vault_id):
             return jsonify({'error': 'Invalid vault ID format'}), 400
         
-        filename = request.args.get('filename')
-        if not filename:
-            return jsonify({'error': 'Filename required for verification'}), 400
+        # Resolve the stored object; filename is optional for indexed files
+        resolved = resolve_vault_file(vault_id, request.args.get('filename'))
+        if resolved is None:
+            return jsonify({'error': 'Vault ID not found'}), 404
         
-        # Download file and verify hash
-        file_content = download_from_spaces(vault_id, filename)
-        if file_content is None:
-            return jsonify({'error': 'File not found in vault'}), 404
+        # Only the index is trusted for the original hash; the object's own
+        # x-amz-meta-sha256 cannot vouch for the object it is attached to
+        filename, original_hash, object_key = resolved
         
-        current_hash = calculate_sha256(file_content)
+        if not original_hash:
+            return jsonify({'error': 'Original hash not found in vault index'}), 404
         
-        # Find original hash in log
-        original_hash = None
-        try:
-            with open(VAULT_LOG_FILE, 'r') as f:
-                for line in f:
-                    entry = json.loads(line.strip())
-                    if (entry.get('vault_id') == vault_id and 
-                        entry.get('filename') == filename and 
-                        entry.get('operation') == 'ingest'):
-                        original_hash = entry.get('sha256_hash')
-                        break
-        except FileNotFoundError:
-            return jsonify({'error': 'Vault log not found'}), 404
+        # Hash the file as it downloads, without buffering it
+        writer = HashingWriter(hashlib.sha256())
+        if not download_from_spaces(object_key, writer):
+            return jsonify({'error': 'File not found in vault'}), 404
         
-        if not original_hash:
-            return jsonify({'error': 'Original hash not found in vault log'}), 404
+        current_hash = writer.sha256.hexdigest()
         
         integrity_verified = current_hash == original_hash
         
@@ -265,7 +533,7 @@ def verify_consciousness(vault_id):
             'original_hash': original_hash,
             'current_hash': current_hash,
             'integrity_verified': integrity_verified,
-            'file_size': len(file_content),
+            'file_size': writer.bytes_written,
             'timestamp': datetime.utcnow().isoformat()
         })
         
@@ -273,11 +541,18 @@ def verify_consciousness(vault_id):
         logger.error(f"Error verifying consciousness: {e}")
         return jsonify({'error': 'Internal server error during verification'}), 500
 
+# Create the vault index on import so it exists under gunicorn too; a broken
+# index or log must not stop workers from booting
+try:
+    init_vault_index()
+except (sqlite3.Error, OSError) as e:
+    logger.error(f"Failed to initialize vault index: {e}")
+
 if __name__ == '__main__':
     # Create vault log file if it doesn't exist
     if not os.path.exists(VAULT_LOG_FILE):
         with open(VAULT_LOG_FILE, 'w') as f:
             pass
     
-    # Run Flask app
+    # Run Flask development server (production uses gunicorn, see deploy.sh)
     app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
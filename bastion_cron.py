@@ -2,13 +2,22 @@
 # Bastion hourly integrity checks for consciousness vault
 # Runs every hour to verify file integrity and vault status
 
-import json
+import atexit
 import os
+import shutil
 import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import logging
+from vault_common import (
+    VAULT_INDEX_DB, JsonlLogWriter, HashingWriter, get_index_connection,
+    ensure_index_schema, legacy_object_key
+)
 
 # Configure logging
 logging.basicConfig(
@@ -28,26 +37,72 @@ SPACES_BUCKET = 'aicara-vault'
 SPACES_REGION = 'nyc3'
 SPACES_ENDPOINT = f'https://{SPACES_REGION}.digitaloceanspaces.com'
 
-# Initialize Spaces client
+VERIFY_MAX_WORKERS = 32  # Concurrent file verifications
+
+# Ingest stages uploads here before copying them to their content-addressed key
+STAGING_PREFIX = 'incoming/'
+STALE_UPLOAD_AGE = timedelta(hours=24)  # Far longer than any ingest takes
+
+# An unchanged ETag does not prove the stored bytes are intact, so every file
+# is fully re-hashed at least this often
+VERIFY_CACHE_MAX_AGE = timedelta(days=7)
+
+# Keep-alive connection pool sized for the verify workers; adaptive retries
+# absorb transient Spaces failures
+SPACES_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=30,
+    retries={'mode': 'adaptive', 'max_attempts': 5}
+)
+
+# Initialize Spaces client (thread-safe, shared by all verify workers)
 spaces_client = boto3.client(
     's3',
     endpoint_url=SPACES_ENDPOINT,
     aws_access_key_id=SPACES_KEY,
     aws_secret_access_key=SPACES_SECRET,
-    region_name=SPACES_REGION
+    region_name=SPACES_REGION,
+    config=SPACES_CLIENT_CONFIG
 )
 
-VAULT_LOG_FILE = 'vault_log.jsonl'
 INTEGRITY_LOG_FILE = 'bastion_integrity.jsonl'
+# 1MB chunks for streamed hashing. Chunks >= 2048 bytes release the GIL in
+# CPython's _hashopenssl.c, letting worker threads hash in parallel - do not shrink.
+HASH_CHUNK_SIZE = 1024 * 1024
 
-def calculate_sha256(file_content):
-    """Calculate SHA-256 hash of file content"""
-    return hashlib.sha256(file_content).hexdigest()
+# Range GETs for large objects; 2 per file keeps all workers within the 64-connection pool
+DOWNLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=2,
+    io_chunksize=HASH_CHUNK_SIZE
+)
+
+# Background JSONL writer shared with app.py, see vault_common.py
+_log_writer = JsonlLogWriter(INTEGRITY_LOG_FILE, 'integrity log', 'integrity-log-writer')
+write_log_entry = _log_writer.write
+shutdown_log_writer = _log_writer.shutdown
+
+atexit.register(shutdown_log_writer)
+
+# Per-file log entries share a timestamp string refreshed every half second
+_ts_cache = {'t': 0.0, 's': ''}
+
+def now_iso():
+    """Return a cached second-precision UTC ISO timestamp, at most half a second stale"""
+    t = time.time()
+    ts = _ts_cache
+    if t - ts['t'] > 0.5:
+        ts['s'] = datetime.utcfromtimestamp(t).isoformat(timespec='seconds')
+        ts['t'] = t
+    return ts['s']
 
 def log_integrity_check(vault_id, filename, status, original_hash=None, current_hash=None, error=None):
     """Log integrity check results"""
     log_entry = {
-        'timestamp': datetime.utcnow().isoformat(),
+        'timestamp': now_iso(),
         'check_type': 'integrity_verification',
         'vault_id': vault_id,
         'filename': filename,
@@ -59,61 +114,120 @@ def log_integrity_check(vault_id, filename, status, original_hash=None, current_
     }
     
     try:
-        with open(INTEGRITY_LOG_FILE, 'a') as f:
-            f.write(json.dumps(log_entry) + '\n')
+        write_log_entry(log_entry)
     except Exception as e:
         logger.error(f"Failed to write integrity log: {e}")
 
+def record_verified_etag(vault_id, filename, etag):
+    """Remember the ETag of an object whose hash was just verified"""
+    try:
+        conn = get_index_connection()
+        try:
+            with conn:
+                conn.execute(
+                    'UPDATE ingest SET last_etag = ?, last_verified_ts = ? '
+                    'WHERE vault_id = ? AND filename = ?',
+                    (etag, now_iso(), vault_id, filename)
+                )
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error(f"Failed to update vault index for {vault_id}/{filename}: {e}")
+
 def get_vault_files():
-    """Get all consciousness files from vault log"""
+    """Get all consciousness files from vault index"""
     vault_files = []
     
+    if not os.path.exists(VAULT_INDEX_DB):
+        logger.warning("Vault index not found")
+        return vault_files
+    
+    # ISO timestamps compare correctly as strings
+    cache_cutoff = (datetime.utcnow() - VERIFY_CACHE_MAX_AGE).isoformat()
+    
     try:
-        with open(VAULT_LOG_FILE, 'r') as f:
-            for line in f:
-                entry = json.loads(line.strip())
-                if entry.get('operation') == 'ingest' and entry.get('status') == 'success':
-                    vault_files.append({
-                        'vault_id': entry.get('vault_id'),
-                        'filename': entry.get('filename'),
-                        'original_hash': entry.get('sha256_hash'),
-                        'timestamp': entry.get('timestamp')
-                    })
-    except FileNotFoundError:
-        logger.warning("Vault log file not found")
+        conn = get_index_connection()
+        try:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                ensure_index_schema(conn)
+            rows = conn.execute(
+                'SELECT vault_id, filename, sha256, ts, object_key, last_etag, last_verified_ts FROM ingest'
+            ).fetchall()
+        finally:
+            conn.close()
+        
+        for vault_id, filename, sha256, ts, object_key, last_etag, last_verified_ts in rows:
+            if not last_verified_ts or last_verified_ts < cache_cutoff:
+                last_etag = None  # Cached verification expired, re-hash this file
+            vault_files.append({
+                'vault_id': vault_id,
+                'filename': filename,
+                'original_hash': sha256,
+                'timestamp': ts,
+                'object_key': object_key or legacy_object_key(vault_id, filename),
+                'last_etag': last_etag
+            })
     except Exception as e:
-        logger.error(f"Error reading vault log: {e}")
+        logger.error(f"Error reading vault index: {e}")
     
     return vault_files
 
-def download_from_spaces(vault_id, filename):
-    """Download file from DigitalOcean Spaces"""
-    try:
-        response = spaces_client.get_object(
-            Bucket=SPACES_BUCKET,
-            Key=f'consciousness/{vault_id}/{filename}'
-        )
-        return response['Body'].read()
-    except ClientError as e:
-        logger.error(f"Failed to download {filename} for {vault_id}: {e}")
-        return None
+# Spaces error codes for a missing object (HEAD reports a bare status code)
+NOT_FOUND_CODES = ('404', 'NoSuchKey', 'NotFound')
+
+def describe_spaces_error(e):
+    """Describe a Spaces ClientError for the integrity log, keeping its error code"""
+    code = e.response.get('Error', {}).get('Code')
+    if code in NOT_FOUND_CODES:
+        return 'File not found in Spaces'
+    return f'Spaces error {code}: {e}'
 
-def verify_file_integrity(vault_id, filename, original_hash):
+def head_from_spaces(key):
+    """Fetch object metadata from DigitalOcean Spaces without the body (raises ClientError)"""
+    return spaces_client.head_object(Bucket=SPACES_BUCKET, Key=key)
+
+def download_from_spaces(key, fileobj):
+    """Download file from DigitalOcean Spaces into a writable file object (raises ClientError)"""
+    spaces_client.download_fileobj(
+        SPACES_BUCKET,
+        key,
+        fileobj,
+        Config=DOWNLOAD_TRANSFER_CONFIG
+    )
+
+def verify_file_integrity(vault_id, filename, original_hash, last_etag=None, object_key=None):
     """Verify integrity of a single consciousness file"""
+    if object_key is None:
+        object_key = legacy_object_key(vault_id, filename)
+    
     try:
-        # Download file from Spaces
-        file_content = download_from_spaces(vault_id, filename)
+        # Skip the download if the object is unchanged since its last verification
+        head = head_from_spaces(object_key)
         
-        if file_content is None:
-            log_integrity_check(vault_id, filename, 'failed', original_hash, None, 'File not found in Spaces')
+        # Objects carry their ingest hash as metadata; a mismatch needs no download
+        stored_hash = head.get('Metadata', {}).get('sha256')
+        if stored_hash and stored_hash != original_hash:
+            log_integrity_check(vault_id, filename, 'corrupted', original_hash, None, 'Stored hash metadata mismatch')
+            logger.error(f"❌ Integrity FAILED: {vault_id}/{filename} - Stored hash metadata mismatch!")
             return False
         
-        # Calculate current hash
-        current_hash = calculate_sha256(file_content)
+        etag = head.get('ETag')
+        if last_etag and etag == last_etag:
+            log_integrity_check(vault_id, filename, 'verified_cached', original_hash)
+            logger.info(f"✅ Integrity verified (unchanged ETag): {vault_id}/{filename}")
+            return True
+        
+        # Hash the file as it downloads, without buffering it
+        writer = HashingWriter(hashlib.sha256())
+        download_from_spaces(object_key, writer)
+        
+        current_hash = writer.sha256.hexdigest()
         
         # Compare hashes
         if current_hash == original_hash:
             log_integrity_check(vault_id, filename, 'verified', original_hash, current_hash)
+            record_verified_etag(vault_id, filename, etag)
             logger.info(f"✅ Integrity verified: {vault_id}/{filename}")
             return True
         else:
@@ -121,21 +235,31 @@ def verify_file_integrity(vault_id, filename, original_hash):
             logger.error(f"❌ Integrity FAILED: {vault_id}/{filename} - Hash mismatch!")
             return False
             
+    except ClientError as e:
+        # Not found, but also bad credentials or a 403, recorded with its code
+        error = describe_spaces_error(e)
+        log_integrity_check(vault_id, filename, 'failed', original_hash, None, error)
+        logger.error(f"❌ Cannot check {vault_id}/{filename}: {error}")
+        return False
     except Exception as e:
         log_integrity_check(vault_id, filename, 'error', original_hash, None, str(e))
         logger.error(f"❌ Error verifying {vault_id}/{filename}: {e}")
         return False
 
-def check_spaces_connectivity():
-    """Verify connection to DigitalOcean Spaces"""
-    try:
-        # Try to list bucket (this verifies connectivity and permissions)
-        response = spaces_client.head_bucket(Bucket=SPACES_BUCKET)
-        logger.info("✅ Spaces connectivity verified")
-        return True
-    except ClientError as e:
-        logger.error(f"❌ Spaces connectivity failed: {e}")
-        return False
+def verify_vault_file(file_info):
+    """Verify a single vault_files entry (thread pool worker)"""
+    vault_id = file_info['vault_id']
+    filename = file_info['filename']
+    
+    logger.info(f"Verifying: {vault_id}/{filename}")
+    
+    return verify_file_integrity(
+        vault_id,
+        filename,
+        file_info['original_hash'],
+        file_info['last_etag'],
+        file_info['object_key']
+    )
 
 def run_integrity_check():
     """Main integrity check function"""
@@ -143,11 +267,6 @@ def run_integrity_check():
     
     check_start_time = datetime.utcnow()
     
-    # Verify Spaces connectivity
-    if not check_spaces_connectivity():
-        logger.error("❌ Cannot proceed - Spaces connectivity failed")
-        return
-    
     # Get all vault files
     vault_files = get_vault_files()
     
@@ -157,21 +276,15 @@ def run_integrity_check():
     
     logger.info(f"🔍 Checking integrity of {len(vault_files)} consciousness files...")
     
-    verified_count = 0
-    failed_count = 0
+    # Check files concurrently so Spaces GET latency overlaps. Threads suffice:
+    # hashlib releases the GIL for each chunk, so they already hash on every
+    # core, and a per-core process pool would cut GET concurrency to the core
+    # count (fully serial on a 1-vCPU droplet).
+    with ThreadPoolExecutor(max_workers=VERIFY_MAX_WORKERS) as executor:
+        results = list(executor.map(verify_vault_file, vault_files))
     
-    # Check each file
-    for file_info in vault_files:
-        vault_id = file_info['vault_id']
-        filename = file_info['filename']
-        original_hash = file_info['original_hash']
-        
-        logger.info(f"Verifying: {vault_id}/{filename}")
-        
-        if verify_file_integrity(vault_id, filename, original_hash):
-            verified_count += 1
-        else:
-            failed_count += 1
+    verified_count = sum(results)
+    failed_count = len(results) - verified_count
     
     # Log summary
     check_duration = (datetime.utcnow() - check_start_time).total_seconds()
@@ -187,8 +300,7 @@ def run_integrity_check():
     }
     
     try:
-        with open(INTEGRITY_LOG_FILE, 'a') as f:
-            f.write(json.dumps(summary_log) + '\n')
+        write_log_entry(summary_log)
     except Exception as e:
         logger.error(f"Failed to write summary log: {e}")
     
@@ -200,19 +312,57 @@ def run_integrity_check():
     if failed_count > 0:
         logger.warning(f"⚠️ {failed_count} files failed integrity check!")
 
+def cleanup_stale_uploads():
+    """Remove staged ingest uploads left behind by workers that died mid-ingest"""
+    cutoff = datetime.now(timezone.utc) - STALE_UPLOAD_AGE
+    removed_count = 0
+    
+    try:
+        # Completed uploads that were never copied to their content key
+        paginator = spaces_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=SPACES_BUCKET, Prefix=STAGING_PREFIX):
+            stale = [{'Key': obj['Key']} for obj in page.get('Contents', []) if obj['LastModified'] < cutoff]
+            if stale:
+                spaces_client.delete_objects(Bucket=SPACES_BUCKET, Delete={'Objects': stale, 'Quiet': True})
+                removed_count += len(stale)
+        
+        # Multipart uploads that were never completed or aborted
+        paginator = spaces_client.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=SPACES_BUCKET, Prefix=STAGING_PREFIX):
+            for upload in page.get('Uploads', []):
+                if upload['Initiated'] < cutoff:
+                    spaces_client.abort_multipart_upload(
+                        Bucket=SPACES_BUCKET,
+                        Key=upload['Key'],
+                        UploadId=upload['UploadId']
+                    )
+                    removed_count += 1
+        
+        if removed_count:
+            logger.info(f"🧹 Removed {removed_count} stale staged uploads")
+    
+    except ClientError as e:
+        logger.error(f"Failed to cleanup staged uploads: {e}")
+
 def cleanup_old_logs():
     """Clean up old integrity logs (keep last 1000 entries)"""
     try:
         if not os.path.exists(INTEGRITY_LOG_FILE):
             return
         
-        with open(INTEGRITY_LOG_FILE, 'r') as f:
-            lines = f.readlines()
+        # First pass: count lines without holding them in memory
+        with open(INTEGRITY_LOG_FILE, 'rb') as f:
+            line_count = sum(1 for _ in f)
         
-        if len(lines) > 1000:
-            # Keep last 1000 lines
-            with open(INTEGRITY_LOG_FILE, 'w') as f:
-                f.writelines(lines[-1000:])
+        if line_count > 1000:
+            # Second pass: skip to the last 1000 lines and copy them to a temp file
+            tmp_log_file = INTEGRITY_LOG_FILE + '.tmp'
+            with open(INTEGRITY_LOG_FILE, 'rb') as src, open(tmp_log_file, 'wb') as dst:
+                for _ in range(line_count - 1000):
+                    src.readline()
+                shutil.copyfileobj(src, dst, 64 * 1024)
+            
+            os.replace(tmp_log_file, INTEGRITY_LOG_FILE)
             logger.info(f"🧹 Cleaned up integrity log - kept last 1000 entries")
     
     except Exception as e:
@@ -223,6 +373,12 @@ if __name__ == '__main__':
         # Run integrity check
         run_integrity_check()
         
+        # Remove uploads abandoned between staging and content-addressed copy
+        cleanup_stale_uploads()
+        
+        # Flush queued log entries before rewriting the log file
+        shutdown_log_writer()
+        
         # Cleanup old logs
         cleanup_old_logs()
         
@@ -240,7 +396,6 @@ if __name__ == '__main__':
         }
         
         try:
-            with open(INTEGRITY_LOG_FILE, 'a') as f:
-                f.write(json.dumps(error_log) + '\n')
+            write_log_entry(error_log)
         except:
             pass
\ No newline at end of file
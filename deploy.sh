@@ -31,7 +31,7 @@ User=root
 WorkingDirectory=/root/aicara-relay
 Environment=DO_SPACES_KEY=${DO_SPACES_KEY}
 Environment=DO_SPACES_SECRET=${DO_SPACES_SECRET}
-ExecStart=/usr/local/bin/gunicorn --bind 0.0.0.0:5000 --workers 2 app:app
+ExecStart=/usr/local/bin/gunicorn --worker-class gevent --workers 4 --worker-connections 100 --bind 0.0.0.0:5000 app:app
 Restart=always
 RestartSec=3
 
@@ -0,0 +1,144 @@
+# aicara-relay/vault_common.py
+# Shared helpers for the relay and the bastion integrity checks:
+# background JSONL log writer, hashing sink, vault index
+
+import orjson
+import queue
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+VAULT_INDEX_DB = 'vault_index.db'
+
+# Background JSONL writer: callers enqueue entries, one thread appends them
+LOG_QUEUE_SIZE = 10000
+LOG_WRITE_BATCH = 64
+_LOG_STOP = object()
+
+class JsonlLogWriter:
+    """Append-only JSONL log fed through a bounded queue and one writer thread
+    
+    Entries are written inline when the queue is full or the thread has died,
+    so logging never blocks a request. Entries orjson cannot serialize are
+    logged and skipped.
+    """
+    
+    def __init__(self, path, label, thread_name):
+        self.path = path
+        self.label = label
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._writer_loop, name=thread_name, daemon=True)
+        self._thread.start()
+    
+    def _writer_loop(self):
+        """Drain the queue into the log file, batching up to LOG_WRITE_BATCH entries per write"""
+        with open(self.path, 'ab') as f:
+            while True:
+                batch = [self._queue.get()]
+                while len(batch) < LOG_WRITE_BATCH:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                
+                # Serialize entries one by one so a bad entry costs only itself
+                lines = []
+                for entry in batch:
+                    if entry is _LOG_STOP:
+                        continue
+                    try:
+                        lines.append(orjson.dumps(entry) + b'\n')
+                    except orjson.JSONEncodeError as e:
+                        logger.error(f"Skipping unserializable {self.label} entry: {e}")
+                
+                try:
+                    f.write(b''.join(lines))
+                    f.flush()
+                except Exception as e:
+                    logger.error(f"Failed to write {self.label}: {e}")
+                
+                if any(entry is _LOG_STOP for entry in batch):
+                    return
+    
+    def _append(self, entry):
+        """Append a single log entry to the log file directly"""
+        with open(self.path, 'ab') as f:
+            f.write(orjson.dumps(entry) + b'\n')
+    
+    def write(self, entry):
+        """Queue a log entry for the writer thread, writing inline if it is unavailable or full"""
+        if self._thread.is_alive():
+            try:
+                self._queue.put_nowait(entry)
+                return
+            except queue.Full:
+                pass
+        
+        self._append(entry)
+    
+    def shutdown(self):
+        """Flush queued log entries and stop the writer thread"""
+        if self._thread.is_alive():
+            self._queue.put(_LOG_STOP)
+            self._thread.join(timeout=10)
+        
+        # Write anything queued after the stop marker was taken
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is not _LOG_STOP:
+                self._append(entry)
+
+class HashingWriter:
+    """Write-only sink that hashes and counts bytes as they are written
+    
+    Deliberately exposes no seek/tell so boto3 hands over ranged downloads
+    strictly in order, which keeps the running hash correct.
+    """
+    
+    def __init__(self, sha256):
+        self.sha256 = sha256
+        self.bytes_written = 0
+    
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+def get_index_connection():
+    """Open a connection to the SQLite vault index"""
+    conn = sqlite3.connect(VAULT_INDEX_DB)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+# Columns added to ingest after it was first created, migrated in place
+INDEX_ADDED_COLUMNS = ('object_key', 'last_etag', 'last_verified_ts')
+
+def ensure_index_schema(conn):
+    """Create the ingest table and add any missing columns
+    
+    Call inside a write transaction (BEGIN IMMEDIATE) so the relay and Bastion
+    cannot both see a column missing and race to add it.
+    """
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS ingest ('
+        'vault_id TEXT, filename TEXT, sha256 TEXT, ts TEXT, object_key TEXT, '
+        'last_etag TEXT, last_verified_ts TEXT, '
+        'PRIMARY KEY (vault_id, filename))'
+    )
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(ingest)')}
+    for column in INDEX_ADDED_COLUMNS:
+        if column not in columns:
+            conn.execute(f'ALTER TABLE ingest ADD COLUMN {column} TEXT')
+
+def legacy_object_key(vault_id, filename):
+    """Spaces key used for files stored before content addressing
+    
+    Index rows with a NULL object_key live here.
+    """
+    return f'consciousness/{vault_id}/{filename}'